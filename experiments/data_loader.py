@@ -1,6 +1,8 @@
 import numpy as np
 from abc import ABC, abstractmethod
 import os
+import stat
+import tempfile
 from typing import Tuple, List, Optional, Union
 
 
@@ -27,7 +29,7 @@ def read_ivecs_file(filename: str, range: Optional[tuple[int, int]] = None) -> n
 
 def read_bvecs_file(filename: str, range: Optional[tuple[int, int]] = None) -> np.ndarray:
     with open(filename, "rb") as f:
-        dimension = np.fromfile(f, dtype=np.int32, count=1)[0]
+        dimension = int(np.fromfile(f, dtype=np.int32, count=1)[0])
         vec_size = 4 + dimension
 
         f.seek(0, 2)
@@ -40,14 +42,66 @@ def read_bvecs_file(filename: str, range: Optional[tuple[int, int]] = None) -> n
 
         assert 1 <= start <= end <= total_vectors, "Invalid range specified."
 
-        f.seek((start - 1) * vec_size, 0)
-        v = np.fromfile(
-            f, dtype=np.uint8, count=(dimension + 4) * (end - start + 1)
-        )
-        return v.reshape((end - start + 1, dimension + 4))[:, 4:]
+    # Memory-map the records so that vectors are only read from disk when accessed.
+    v = np.memmap(
+        filename,
+        dtype=np.uint8,
+        mode="r",
+        offset=(start - 1) * vec_size,
+        shape=(end - start + 1, dimension + 4),
+    )
+    return v[:, 4:]
+
+
+# Number of rows converted at a time when writing a float32 mirror of a dataset.
+MIRROR_CHUNK_SIZE = 1_000_000
+
+
+def load_float32_mirror(source_path: str, mirror_path: str, data: np.ndarray) -> np.ndarray:
+    """
+    Returns a memory-mapped float32 copy of `data`, which was loaded from `source_path`.
+    The copy is written to `mirror_path` in chunks the first time (or whenever the
+    source file is newer than the mirror, or the mirror's shape doesn't match `data`)
+    and reused on subsequent runs. `data` is only read when the mirror is (re)built.
+    """
+    is_stale = (
+        not os.path.exists(mirror_path)
+        or os.path.getmtime(mirror_path) < os.path.getmtime(source_path)
+        or np.load(mirror_path, mmap_mode="r").shape != data.shape
+    )
+    if is_stale:
+        # Write to a uniquely named temporary file first so that an interrupted run
+        # doesn't leave a truncated mirror behind, and concurrent runs don't write to
+        # the same file.
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(mirror_path) or ".", suffix=".tmp", delete=False
+        ) as temporary_file:
+            temporary_path = temporary_file.name
+        try:
+            mirror = np.lib.format.open_memmap(
+                temporary_path, mode="w+", dtype=np.float32, shape=data.shape
+            )
+            for start in range(0, data.shape[0], MIRROR_CHUNK_SIZE):
+                mirror[start : start + MIRROR_CHUNK_SIZE] = data[
+                    start : start + MIRROR_CHUNK_SIZE
+                ]
+            mirror.flush()
+            del mirror
+            # Temporary files are created with mode 0600. Give the mirror the source
+            # file's permissions so that it stays readable in shared dataset directories.
+            os.chmod(temporary_path, stat.S_IMODE(os.stat(source_path).st_mode))
+            os.replace(temporary_path, mirror_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    return np.load(mirror_path, mmap_mode="r")
 
 
 class DatasetLoader(ABC):
+    # Whether `load_data` applies the range to the queries as well as the train dataset.
+    applies_range_to_queries = False
+
     def __init__(
         self,
         train_dataset_path: str,
@@ -88,19 +142,45 @@ class DatasetLoader(ABC):
     def load_data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         pass
 
+    def load_float32_data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Same as `load_data`, but the train dataset and queries are returned as float32.
+        Data stored with another dtype is converted once into a float32 .npy mirror
+        next to the original file, which is memory-mapped on subsequent runs.
+        NOTE: The mirror is 4x the size of a uint8/int8 source file.
+        All loaders memory-map the train dataset and queries, so `load_data` doesn't read
+        the source vectors; they are only read when a mirror has to be (re)built.
+        """
+        train_dataset, queries, ground_truth = self.load_data()
+
+        range_suffix = f".{self.range[0]}-{self.range[1]}" if self.range else ""
+        queries_range_suffix = range_suffix if self.applies_range_to_queries else ""
+        if train_dataset.dtype != np.float32:
+            train_dataset = load_float32_mirror(
+                source_path=self.train_dataset_path,
+                mirror_path=f"{self.train_dataset_path}{range_suffix}.f32.npy",
+                data=train_dataset,
+            )
+        if queries.dtype != np.float32:
+            queries = load_float32_mirror(
+                source_path=self.queries_path,
+                mirror_path=f"{self.queries_path}{queries_range_suffix}.f32.npy",
+                data=queries,
+            )
+
+        return train_dataset, queries, ground_truth
+
 
 class NpyDatasetLoader(DatasetLoader):
     def load_data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Memory-map the train dataset and queries so that they are paged in on demand
+        # instead of being read into memory upfront.
+        train_dataset = np.load(self.train_dataset_path, mmap_mode="r")
         if self.range:
             start_index, end_index = self.range
-            train_dataset = np.load(self.train_dataset_path)[
-                start_index:end_index
-            ].astype(np.float32, copy=False)
-        else:
-            train_dataset = np.load(self.train_dataset_path).astype(
-                np.float32, copy=False
-            )
-        queries = np.load(self.queries_path).astype(np.float32, copy=False)
+            train_dataset = train_dataset[start_index:end_index]
+
+        queries = np.load(self.queries_path, mmap_mode="r")
         ground_truth = np.load(self.ground_truth_path).astype(np.int32, copy=False)
         return train_dataset, queries, ground_truth
 
@@ -114,6 +194,8 @@ class BvecsDatasetLoader(DatasetLoader):
     NOTE: This is mostly for loading the SIFT1B dataset.
     """
 
+    applies_range_to_queries = True
+
     def load_data(self) -> Tuple[np.ndarray]:
         ground_truth = read_ivecs_file(self.ground_truth_path, self.range)
         # Ground truth has shape (10000, 1000) but we only need the first 100 queries
@@ -153,25 +235,17 @@ class BinaryDatasetLoader(DatasetLoader):
             return ground_truth, None, num_queries, K
 
 
-        with open(path, "rb") as f:
-            num_queries = np.fromfile(f, dtype=np.uint32, count=1)[0]
-            K = np.fromfile(f, dtype=np.uint32, count=1)[0]
-
-        # Memory-map the IDs only
-        ground_truth_ids = np.memmap(
-            path,
-            dtype=np.uint32,
-            mode="r",
-            shape=(num_queries, K),
-            offset=8,
-        )
+        # Map the whole file once. The header, the IDs and the distances are all views
+        # into the same mapping.
+        ground_truth = np.memmap(path, dtype=np.uint32, mode="r")
+        num_queries, K = int(ground_truth[0]), int(ground_truth[1])
+        num_entries = num_queries * K
 
-        ground_truth_dists = np.memmap(
-            path,
-            dtype=np.float32,
-            mode="r",
-            shape=(num_queries, K),
-            offset=8 + (num_queries * K * np.dtype(np.uint32).itemsize),
+        ground_truth_ids = ground_truth[2 : 2 + num_entries].reshape(num_queries, K)
+        ground_truth_dists = (
+            ground_truth[2 + num_entries : 2 + 2 * num_entries]
+            .view(np.float32)
+            .reshape(num_queries, K)
         )
 
         return ground_truth_ids, ground_truth_dists, num_queries, K
@@ -203,18 +277,22 @@ class BinaryDatasetLoader(DatasetLoader):
                 shape=(chunk_size, num_dimensions),
             )
         else:
-            train_dataset = np.fromfile(
-                self.train_dataset_path, dtype=self.dtype, offset=8
+            train_dataset = np.memmap(
+                self.train_dataset_path,
+                dtype=self.dtype,
+                mode="r",
+                offset=8,
+                shape=(num_points, num_dimensions),
             )
-            train_dataset = train_dataset.reshape((num_points, num_dimensions))
 
         ground_truth, _, num_queries, _ = self.load_ground_truth(self.ground_truth_path)
-        queries_dataset = np.fromfile(
+        queries_dataset = np.memmap(
             self.queries_path,
             dtype=self.dtype,
+            mode="r",
             offset=8,
+            shape=(num_queries, num_dimensions),
         )
-        queries_dataset = queries_dataset.reshape((num_queries, num_dimensions))
 
         return train_dataset, queries_dataset, ground_truth
 
@@ -1,5 +1,6 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 import numpy as np
+from numba import njit, prange
 from pydantic import BaseModel, validator
 import inspect
 
@@ -50,27 +51,78 @@ class MetricManager:
         return eval_function(**function_kwargs)
 
 
-def compute_recall(
-    queries: np.ndarray, ground_truth: np.ndarray, top_k_indices: List[int], k: int
-) -> float:
-    ground_truth_sets = [set(gt) for gt in ground_truth]
-    mean_recall = 0
+@njit(parallel=True, cache=True, fastmath=True)
+def _count_hits(top_k_indices: np.ndarray, ground_truth_sorted: np.ndarray) -> np.ndarray:
+    """
+    Counts, for each query, how many of its top-k ids are present in the corresponding
+    row of the sorted ground truth. Each id is looked up with a binary search.
+    """
+    num_queries, k = top_k_indices.shape
+    row_size = ground_truth_sorted.shape[1]
+    hits = np.zeros(num_queries, dtype=np.int64)
+
+    for query_index in prange(num_queries):
+        query_hits = 0
+        for neighbor_index in range(k):
+            neighbor = top_k_indices[query_index, neighbor_index]
+            low, high = 0, row_size
+            while low < high:
+                mid = (low + high) // 2
+                if ground_truth_sorted[query_index, mid] < neighbor:
+                    low = mid + 1
+                else:
+                    high = mid
+            if low < row_size and ground_truth_sorted[query_index, low] == neighbor:
+                query_hits += 1
+        hits[query_index] = query_hits
+
+    return hits
+
+
+class RecallEvaluator:
+    """
+    Computes recall@k against a fixed ground truth. The ground truth is prepared once
+    at construction, so the same evaluator can be reused for every run in a sweep.
+    """
+
+    def __init__(self, ground_truth: np.ndarray, k: int):
+        self.k = k
+        # Keep the first k ids of each query sorted so that `_count_hits` can binary
+        # search them. The ids are stored as uint32 to match the top-k indices produced
+        # by the benchmark runner, so neither array needs to be cast.
+        self.ground_truth_sorted = ground_truth[:, :k].astype(np.uint32)
+        self.ground_truth_sorted.sort(axis=1)
+
+    def recall(self, top_k_indices: np.ndarray) -> float:
+        # `_count_hits` does no bounds checking, so mismatched shapes must be caught here.
+        expected_shape = (self.ground_truth_sorted.shape[0], self.k)
+        if top_k_indices.shape != expected_shape:
+            raise ValueError(
+                f"Expected top-k indices of shape {expected_shape}, "
+                f"got {top_k_indices.shape}."
+            )
+        hits = _count_hits(top_k_indices, self.ground_truth_sorted)
+        return hits.sum() / (len(top_k_indices) * self.k)
+
 
-    for idx, k_neighbors in enumerate(top_k_indices):
-        query_recall = sum(
-            1 for neighbor in k_neighbors if neighbor in ground_truth_sets[idx]
-        )
-        mean_recall += query_recall / k
+LATENCY_PERCENTILES = [50, 90, 95, 99, 99.9]
 
-    recall = mean_recall / len(queries)
-    return recall
+
+def compute_latency_percentiles(latencies: np.ndarray) -> Dict[float, float]:
+    """
+    Computes all of LATENCY_PERCENTILES with a single np.percentile call, which
+    partitions the latencies once instead of once per percentile.
+    """
+    return dict(zip(LATENCY_PERCENTILES, np.percentile(latencies, LATENCY_PERCENTILES)))
 
 
 metric_manager = MetricManager()
 metric_manager.register_metric(
     name="recall",
     config=MetricConfig(description="Recall", worst_value=float("-inf"), range=[0, 1]),
-    function=compute_recall,
+    function=lambda recall_evaluator, top_k_indices: recall_evaluator.recall(
+        top_k_indices
+    ),
 )
 metric_manager.register_metric(
     name="qps",
@@ -82,35 +134,35 @@ metric_manager.register_metric(
     config=MetricConfig(
         description="50th percentile latency (ms)", worst_value=float("inf")
     ),
-    function=lambda latencies: np.percentile(latencies, 50) * 1000,
+    function=lambda latency_percentiles: latency_percentiles[50],
 )
 metric_manager.register_metric(
     name="latency_p90",
     config=MetricConfig(
         description="90th percentile latency (ms)", worst_value=float("inf")
     ),
-    function=lambda latencies: np.percentile(latencies, 90) * 1000,
+    function=lambda latency_percentiles: latency_percentiles[90],
 )
 metric_manager.register_metric(
     name="latency_p95",
     config=MetricConfig(
         description="95th percentile latency (ms)", worst_value=float("inf")
     ),
-    function=lambda latencies: np.percentile(latencies, 95) * 1000,
+    function=lambda latency_percentiles: latency_percentiles[95],
 )
 metric_manager.register_metric(
     name="latency_p99",
     config=MetricConfig(
         description="99th percentile latency (ms)", worst_value=float("inf")
     ),
-    function=lambda latencies: np.percentile(latencies, 99) * 1000,
+    function=lambda latency_percentiles: latency_percentiles[99],
 )
 metric_manager.register_metric(
     name="latency_p999",
     config=MetricConfig(
         description="99.9th percentile latency (ms)", worst_value=float("inf")
     ),
-    function=lambda latencies: np.percentile(latencies, 99.9) * 1000,
+    function=lambda latency_percentiles: latency_percentiles[99.9],
 )
 metric_manager.register_metric(
     name="distance_computations",
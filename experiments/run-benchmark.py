@@ -1,8 +1,8 @@
 import time
-import json
+import orjson
 import hnswlib
 import numpy as np
-from typing import Optional, Tuple, List, Dict, Union
+from typing import Optional, Tuple, List, Dict, Union, Iterator, Any
 import numpy as np
 import os
 import logging
@@ -12,7 +12,11 @@ import flatnav
 from flatnav.data_type import DataType
 from data_loader import get_data_loader
 from plotting.plot import create_plot, create_linestyles
-from plotting.metrics import metric_manager
+from plotting.metrics import (
+    metric_manager,
+    compute_latency_percentiles,
+    RecallEvaluator,
+)
 
 
 FLATNAV_DATA_TYPES = {
@@ -21,94 +25,206 @@ FLATNAV_DATA_TYPES = {
     "int8": DataType.int8,
 }
 
-
-ENVIRONMENT_INFO = {
-    "load_before_experiment": os.getloadavg()[2],
-    "platform": platform.platform(),
-    "platform_version": platform.version(),
-    "platform_release": platform.release(),
-    "architecture": platform.machine(),
-    "processor": platform.processor(),
-    "hostname": socket.gethostname(),
-    "ram_gb": round(psutil.virtual_memory().total / (1024.0**3)),
-    "num_cores": psutil.cpu_count(logical=True),
+NUMPY_DATA_TYPES = {
+    "float32": np.float32,
+    "uint8": np.uint8,
+    "int8": np.int8,
 }
 
+# Number of queries per search thread handed to the index per batched search call
+# in `compute_metrics`. Batches are only used for recall, QPS and distance computations,
+# never for latencies.
+SEARCH_BATCH_SIZE = 32
+
+# Maximum number of queries timed one at a time for the latency percentiles when
+# searching with multiple threads. This leaves 10 samples above the 99.9th percentile.
+LATENCY_SAMPLE_SIZE = 10_000
+
+# Number of training vectors paged in and converted to the index data type at a time
+# when the (possibly memory-mapped) training set is added in chunks.
+TRAIN_CHUNK_SIZE = 1_000_000
+
+
+def _env_info() -> Dict[str, Union[str, int, float]]:
+    """
+    Returns a snapshot of the machine the experiment runs on. This reads from /proc,
+    so it is only collected when requested with --log-env.
+    """
+    return {
+        "load_before_experiment": os.getloadavg()[2],
+        "platform": platform.platform(),
+        "platform_version": platform.version(),
+        "platform_release": platform.release(),
+        "architecture": platform.machine(),
+        "processor": platform.processor(),
+        "hostname": socket.gethostname(),
+        "ram_gb": round(psutil.virtual_memory().total / (1024.0**3)),
+        "num_cores": psutil.cpu_count(logical=True),
+    }
+
+
+def iterate_chunks(
+    data: np.ndarray, dtype: np.dtype, chunk_size: int = TRAIN_CHUNK_SIZE
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Yields (start_index, chunk) pairs over the rows of `data`. Each chunk is converted
+    to a C-contiguous array of the given dtype, so for memory-mapped data only one chunk
+    is paged in and converted at a time.
+    """
+    for start_index in range(0, data.shape[0], chunk_size):
+        chunk = data[start_index : start_index + chunk_size]
+        yield start_index, np.ascontiguousarray(chunk, dtype=dtype)
+
+
+def measure_query_latencies(
+    index: Union[hnswlib.Index, flatnav.index.IndexL2Float, flatnav.index.IndexIPFloat],
+    queries: np.ndarray,
+    ef_search: int,
+    k: int,
+    top_k_indices: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Times every query on its own, one after the other, and returns the latencies in
+    milliseconds. Unlike a batched search, this gives true per-query latencies, so the
+    tail percentiles are not averaged away.
+    Assumes `ef_search` has already been set on HNSW indices.
+
+    :param top_k_indices: If given, the ids found for each query are written into it.
+    """
+    is_flatnav_index = not type(index) == hnswlib.Index
+    latencies = np.empty(len(queries), dtype=np.int64)
+
+    for query_index in range(len(queries)):
+        start = time.perf_counter_ns()
+        if is_flatnav_index:
+            _, indices = index.search_single(
+                query=queries[query_index],
+                ef_search=ef_search,
+                K=k,
+                num_initializations=100,
+            )
+        else:
+            indices, _ = index.knn_query(data=queries[query_index : query_index + 1], k=k)
+            indices = indices[0]
+        latencies[query_index] = time.perf_counter_ns() - start
+        if top_k_indices is not None:
+            top_k_indices[query_index] = indices
+
+    return latencies / 1e6
+
+
+def get_distance_computations(
+    index: Union[hnswlib.Index, flatnav.index.IndexL2Float, flatnav.index.IndexIPFloat],
+) -> int:
+    """
+    Returns the number of distance computations since the last call and resets the counter.
+    """
+    if type(index) == hnswlib.Index:
+        # HNSW aggregates distance computations across all queries.
+        return index.get_distance_computations()
+    return index.get_query_distance_computations()
+
 
 def compute_metrics(
     requested_metrics: List[str],
     index: Union[hnswlib.Index, flatnav.index.IndexL2Float, flatnav.index.IndexIPFloat],
     queries: np.ndarray,
-    ground_truth: np.ndarray,
+    recall_evaluator: RecallEvaluator,
     ef_search: int,
     k=100,
+    num_search_threads: int = 1,
 ) -> Dict[str, float]:
     """
     Compute metrics, possibly including recall, QPS, average per query distance computations,
     and latency percentiles for given queries, ground truth for the given index (FlatNav or HNSW).
+    With a single search thread, every query is timed on its own (see `measure_query_latencies`)
+    and those timings give both QPS and the latency percentiles. With more threads, queries are
+    searched in batches, and the latency percentiles come from a separate single-query pass over
+    at most LATENCY_SAMPLE_SIZE queries that only runs if a latency metric is requested.
 
     :param requested_metrics: A list of metrics to compute. Options include `recall`, `qps`, `latency_p50`,
         `latency_p95`, `latency_p99`, and `latency_p999`.
     :param index: Either a FlatNav or HNSW index to search.
     :param queries: The query vectors.
-    :param ground_truth: The ground truth indices for each query.
+    :param recall_evaluator: Evaluates recall against the ground truth for the queries.
     :param ef_search: The size of the dynamic candidate list.
     :param k: Number of neighbors to search.
+    :param num_search_threads: The number of threads the index searches with. Each batched
+        search call gets SEARCH_BATCH_SIZE queries per thread. This only affects QPS; the
+        latency percentiles are always measured one query at a time, so they are comparable
+        across thread counts.
 
     :return: Dictionary of metrics.
 
     """
     is_flatnav_index = not type(index) == hnswlib.Index
-    latencies = []
-    top_k_indices = []
-    distance_computations = []
-
-    if is_flatnav_index:
-        for query in queries:
-            start = time.time()
-            _, indices = index.search_single(
-                query=query,
-                ef_search=ef_search,
-                K=k,
-                num_initializations=100,
-            )
-            end = time.time()
-            latencies.append(end - start)
-            top_k_indices.append(indices)
-
-            # Fetches the total number of distance computations for the last query.
-            # and resets the counter.
-            query_dis_computations = index.get_query_distance_computations()
-            distance_computations.append(query_dis_computations)
+    num_queries = len(queries)
+    top_k_indices = np.empty((num_queries, k), dtype=np.uint32)
+    latencies_ms = None
 
-    else:
+    if not is_flatnav_index:
         index.set_ef(ef_search)
-        for query in queries:
-            start = time.time()
-            indices, _ = index.knn_query(data=np.array([query]), k=k)
-            end = time.time()
-            latencies.append(end - start)
-            top_k_indices.append(indices[0])
 
-        else:
-            # HNSW aggregates distance computations across all queries.
-            distance_computations.append(index.get_distance_computations())
-
-    querying_time = sum(latencies)
-    distance_computations = sum(distance_computations)
-    num_queries = len(queries)
+    if num_search_threads == 1:
+        # With a single search thread, timing every query on its own costs nothing extra,
+        # and the same timings give both the latency percentiles and QPS.
+        latencies_ms = measure_query_latencies(
+            index=index,
+            queries=queries,
+            ef_search=ef_search,
+            k=k,
+            top_k_indices=top_k_indices,
+        )
+        querying_time = latencies_ms.sum() / 1000
+        distance_computations = get_distance_computations(index)
+    else:
+        # Queries are issued in micro-batches so that we only cross into the library once
+        # per batch, and every search thread has queries to work on. This pass is used
+        # for recall, QPS and distance computations.
+        querying_time_ns = 0
+        batch_size = SEARCH_BATCH_SIZE * num_search_threads
+        for batch_start in range(0, num_queries, batch_size):
+            batch_end = min(batch_start + batch_size, num_queries)
+            batch = queries[batch_start:batch_end]
+            start = time.perf_counter_ns()
+            if is_flatnav_index:
+                _, indices = index.search(
+                    queries=batch,
+                    ef_search=ef_search,
+                    K=k,
+                    num_initializations=100,
+                )
+            else:
+                indices, _ = index.knn_query(data=batch, k=k)
+            querying_time_ns += time.perf_counter_ns() - start
+            top_k_indices[batch_start:batch_end] = indices
+
+        querying_time = querying_time_ns / 1e9
+        distance_computations = get_distance_computations(index)
+
+        if any(name.startswith("latency_") for name in requested_metrics):
+            # Latencies come from a separate single-query pass over an evenly spaced
+            # sample of the queries, which bounds the extra search time.
+            step = max(1, num_queries // LATENCY_SAMPLE_SIZE)
+            latencies_ms = measure_query_latencies(
+                index=index, queries=queries[::step], ef_search=ef_search, k=k
+            )
+            # Discard the distance computations from the latency pass so that they
+            # are not counted towards the next call to `compute_metrics`.
+            get_distance_computations(index)
 
     # Construct a kwargs dictionary to pass to the metric functions.
     kwargs = {
         "querying_time": querying_time,
         "num_queries": num_queries,
-        "latencies": latencies,
         "distance_computations": distance_computations,
         "queries": queries,
-        "ground_truth": ground_truth,
+        "recall_evaluator": recall_evaluator,
         "top_k_indices": top_k_indices,
         "k": k,
     }
+    if latencies_ms is not None:
+        kwargs["latency_percentiles"] = compute_latency_percentiles(latencies_ms)
 
     metrics = {}
 
@@ -146,7 +262,14 @@ def create_and_train_hnsw_index(
     hnsw_index.set_num_threads(num_threads)
 
     start = time.time()
-    hnsw_index.add_items(data=data, ids=np.arange(dataset_size))
+    # Add the data in chunks so that memory-mapped data is paged in (and converted
+    # to float32) one chunk at a time.
+    for chunk_start, chunk in iterate_chunks(data, dtype=np.float32):
+        hnsw_index.add_items(
+            data=chunk,
+            ids=np.arange(chunk_start, chunk_start + len(chunk), dtype=np.uint32),
+            num_threads=num_threads,
+        )
     end = time.time()
     logging.info(f"Indexing time = {end - start} seconds")
 
@@ -233,9 +356,12 @@ def train_index(
         # Here we will first allocate memory for the index and then build edge connectivity
         # using the HNSW base layer graph. We do not use the ef-construction parameter since
         # it's assumed to have been used when building the HNSW base layer.
-        index.allocate_nodes(data=train_dataset).build_graph_links(
-            mtx_filename=hnsw_base_layer_filename
-        )
+        if train_dataset.dtype == np.float32 and train_dataset.flags.c_contiguous:
+            index.allocate_nodes(data=train_dataset)
+        else:
+            for _, chunk in iterate_chunks(train_dataset, dtype=np.float32):
+                index.allocate_nodes(data=chunk)
+        index.build_graph_links(mtx_filename=hnsw_base_layer_filename)
         os.remove(hnsw_base_layer_filename)
 
     else:
@@ -252,9 +378,20 @@ def train_index(
 
         # Train the index.
         start = time.time()
-        index.add(
-            data=train_dataset, ef_construction=ef_construction, num_initializations=100
-        )
+        index_dtype = NUMPY_DATA_TYPES[data_type]
+        if train_dataset.dtype == index_dtype and train_dataset.flags.c_contiguous:
+            index.add(
+                data=train_dataset, ef_construction=ef_construction, num_initializations=100
+            )
+        else:
+            # Avoid materializing a converted copy of the whole dataset.
+            for chunk_start, chunk in iterate_chunks(train_dataset, dtype=index_dtype):
+                index.add(
+                    data=chunk,
+                    ef_construction=ef_construction,
+                    num_initializations=100,
+                    labels=np.arange(chunk_start, chunk_start + len(chunk)),
+                )
         end = time.time()
 
         logging.info(f"Indexing time = {end - start} seconds")
@@ -262,6 +399,65 @@ def train_index(
     return index
 
 
+def append_to_metrics_log(metrics_log_file: str, entry: Dict[str, Any]) -> None:
+    """
+    Appends `entry` as one line to the JSON lines log next to the metrics file, so that
+    finished runs survive a crash before they are merged by `merge_metrics_log`.
+    """
+    with open(metrics_log_file, "ab") as file:
+        file.write(
+            orjson.dumps(
+                entry, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+            )
+        )
+
+
+def merge_metrics_log(metrics_file: str, metrics_log_file: str) -> None:
+    """
+    Merges the entries in the JSON lines log into the metrics file and removes the log.
+    The metrics file is re-read right before merging, so results written by other
+    experiments (e.g. the flatnav and hnsw targets share a metrics file) are kept.
+    Rows are appended to the experiment's list of runs; other entries are replaced.
+    """
+    if not os.path.exists(metrics_log_file):
+        return
+
+    all_metrics = {}
+    try:
+        with open(metrics_file, "rb") as file:
+            contents = file.read()
+        if contents:
+            all_metrics = orjson.loads(contents)
+    except FileNotFoundError:
+        pass
+    except orjson.JSONDecodeError:
+        logging.error(f"Error reading {metrics_file=}")
+        # Keep the log around so that its rows aren't lost.
+        return
+
+    with open(metrics_log_file, "rb") as file:
+        for line in file:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # The last line may be truncated if a run crashed while writing it.
+                logging.error(f"Skipping malformed line in {metrics_log_file=}")
+                continue
+            for key, value in entry.items():
+                if key.startswith("_"):
+                    all_metrics[key] = value
+                else:
+                    all_metrics.setdefault(key, []).append(value)
+
+    with open(metrics_file, "wb") as file:
+        file.write(
+            orjson.dumps(
+                all_metrics, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+            )
+        )
+    os.remove(metrics_log_file)
+
+
 def main(
     train_dataset: np.ndarray,
     queries: np.ndarray,
@@ -281,6 +477,8 @@ def main(
     num_initializations: Optional[List[int]] = None,
     num_build_threads: int = 1,
     num_search_threads: int = 1,
+    k: int = 100,
+    environment_info: Optional[Dict[str, Union[str, int, float]]] = None,
 ):
     
     def build_and_run_knn_search(ef_cons: int, node_links: int):
@@ -311,53 +509,55 @@ def main(
         
         index.set_num_threads(num_search_threads)
         for ef_search in ef_search_params:
-            # Extend metrics with computed metrics
-            metrics.update(
-                compute_metrics(
-                    requested_metrics=requested_metrics,
-                    index=index,
-                    queries=queries,
-                    ground_truth=gtruth,
-                    ef_search=ef_search,
-                )
+            row = compute_metrics(
+                requested_metrics=requested_metrics,
+                index=index,
+                queries=queries,
+                recall_evaluator=recall_evaluator,
+                ef_search=ef_search,
+                k=k,
+                num_search_threads=num_search_threads,
             )
-            logging.info(f"Metrics: {metrics}")
-
             # Add parameters to the metrics dictionary.
-            metrics["distance_type"] = distance_type
-            metrics["ef_search"] = ef_search
-            all_metrics = {experiment_key: []}
-
-            if os.path.exists(metrics_file) and os.path.getsize(metrics_file) > 0:
-                with open(metrics_file, "r") as file:
-                    try:
-                        all_metrics = json.load(file)
-                    except json.JSONDecodeError:
-                        logging.error(f"Error reading {metrics_file=}")
-
-            if experiment_key not in all_metrics:
-                all_metrics[experiment_key] = []
-
-            all_metrics[experiment_key].append(metrics)
-            with open(metrics_file, "w") as file:
-                json.dump(all_metrics, file, indent=4)
-    
-    
+            row.update(
+                node_links=node_links,
+                ef_construction=ef_cons,
+                ef_search=ef_search,
+                distance_type=distance_type,
+            )
+            logging.info(f"Metrics: {row}")
+            append_to_metrics_log(metrics_log_file, {experiment_key: row})
+
+
     dataset_size = train_dataset.shape[0]
     dim = train_dataset.shape[1]
 
+    # Convert the queries once up front so that the searches timed in `compute_metrics`
+    # don't pay for a dtype conversion or copy. hnswlib only supports float32 vectors.
+    query_dtype = np.float32 if index_type == "hnsw" else NUMPY_DATA_TYPES[data_type]
+    queries = np.ascontiguousarray(queries, dtype=query_dtype)
+
+    # The ground truth is the same for every run in the sweep, so it is only prepared once.
+    recall_evaluator = RecallEvaluator(ground_truth=gtruth, k=k)
+
     experiment_key = f"{dataset_name}_{index_type}"
+    metrics_log_file = f"{os.path.splitext(metrics_file)[0]}.jsonl"
 
-    for node_links in num_node_links:
-        metrics = {}
-        metrics["node_links"] = node_links
+    # Recover rows left behind by a run that crashed before its rows were merged.
+    merge_metrics_log(metrics_file=metrics_file, metrics_log_file=metrics_log_file)
 
-        for ef_cons in ef_cons_params:
-            metrics["ef_construction"] = ef_cons
+    if environment_info is not None:
+        append_to_metrics_log(
+            metrics_log_file, {f"_env_{experiment_key}": environment_info}
+        )
 
+    for node_links in num_node_links:
+        for ef_cons in ef_cons_params:
             logging.info(f"Building {index_type=}")
             build_and_run_knn_search(ef_cons=ef_cons, node_links=node_links)
 
+    merge_metrics_log(metrics_file=metrics_file, metrics_log_file=metrics_log_file)
+
 
 def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -503,6 +703,20 @@ def parse_arguments() -> argparse.Namespace:
         help="The first element is the start index and the second element is the end index. Must be two integers.",
     )
 
+    parser.add_argument(
+        "--cache-float32-mirror",
+        action="store_true",
+        help="If set and the index uses float32 vectors, write a float32 .npy copy of "
+        "non-float32 datasets next to the source files and memory-map it on later runs. "
+        "The copy is 4x the size of a uint8/int8 dataset.",
+    )
+
+    parser.add_argument(
+        "--log-env",
+        action="store_true",
+        help="If set, save a snapshot of the machine's environment under `_env_<dataset>_<index-type>` in the metrics file.",
+    )
+
     return parser.parse_args()
 
 
@@ -511,11 +725,16 @@ def plot_all_metrics(
     dataset_name: str,
     requested_metrics: List[str],
 ) -> None:
-    with open(metrics_file_path, "r") as file:
-        all_metrics = json.load(file)
-
-    # Only consider data for the current benchmark dataset.
-    all_metrics = {key: value for key, value in all_metrics.items() if dataset_name in key}
+    with open(metrics_file_path, "rb") as file:
+        all_metrics = orjson.loads(file.read())
+
+    # Only consider data for the current benchmark dataset. Keys starting with an
+    # underscore (e.g. `_env_<experiment_key>`) don't hold experiment runs.
+    all_metrics = {
+        key: value
+        for key, value in all_metrics.items()
+        if dataset_name in key and not key.startswith("_")
+    }
 
     linestyles = create_linestyles(unique_algorithms=all_metrics.keys())
     metrics_dir = os.path.dirname(metrics_file_path)
@@ -556,6 +775,7 @@ def run_experiment():
     # This is the root directory inside the Docker container not the host machine.
     ROOT_DIR = "/root"
     args = parse_arguments()
+    environment_info = _env_info() if args.log_env else None
 
     data_loader = get_data_loader(
         train_dataset_path=args.dataset,
@@ -563,7 +783,13 @@ def run_experiment():
         ground_truth_path=args.gtruth,
         range=args.train_dataset_range,
     )
-    train_data, queries, ground_truth = data_loader.load_data()
+    uses_float32 = args.index_type.lower() == "hnsw" or args.data_type == "float32"
+    if args.cache_float32_mirror and uses_float32:
+        # The index works on float32 vectors, so convert datasets stored with another
+        # dtype once on disk rather than on every index build.
+        train_data, queries, ground_truth = data_loader.load_float32_data()
+    else:
+        train_data, queries, ground_truth = data_loader.load_data()
 
     num_initializations = args.num_initializations
     if args.index_type.lower() == "hnsw":
@@ -591,6 +817,7 @@ def run_experiment():
         metrics_file=metrics_file_path,
         num_initializations=num_initializations,
         requested_metrics=args.requested_metrics,
+        environment_info=environment_info,
     )
 
     plot_all_metrics(
@@ -126,10 +126,17 @@ class PyIndex : public std::enable_shared_from_this<PyIndex<dist_t, label_t>> {
       throw std::invalid_argument("Query has incorrect dimensions.");
     }
 
-    std::vector<std::pair<float, label_t>> top_k = this->_index->search(
-        /* query = */ (const void*)query.data(0), /* K = */ K,
-        /* ef_search = */ ef_search,
-        /* num_initializations = */ num_initializations);
+    std::vector<std::pair<float, label_t>> top_k;
+    {
+      // Release python GIL while searching. Searches can then overlap with other
+      // methods called from Python threads. Mutators such as `reorder` are not safe
+      // to run concurrently with a search on the same index.
+      py::gil_scoped_release gil;
+      top_k = this->_index->search(
+          /* query = */ (const void*)query.data(0), /* K = */ K,
+          /* ef_search = */ ef_search,
+          /* num_initializations = */ num_initializations);
+    }
 
     if (top_k.size() != K) {
       throw std::runtime_error("Search did not return the expected number of results. Expected " +
@@ -173,42 +180,49 @@ class PyIndex : public std::enable_shared_from_this<PyIndex<dist_t, label_t>> {
     label_t* results = new label_t[num_queries * K];
     float* distances = new float[num_queries * K];
 
-    // No need to spawn any threads if we are in a single-threaded environment
-    if (num_threads == 1) {
-      for (size_t query_index = 0; query_index < num_queries; query_index++) {
-        std::vector<std::pair<float, label_t>> top_k = this->_index->search(
-            /* query = */ (const void*)queries.data(query_index), /* K = */ K,
-            /* ef_search = */ ef_search,
-            /* num_initializations = */ num_initializations);
-
-        if (top_k.size() != K) {
-          throw std::runtime_error(
-              "Search did not return the expected number "
-              "of results. Expected " +
-              std::to_string(K) + " but got " + std::to_string(top_k.size()) + ".");
-        }
-
-        for (size_t i = 0; i < top_k.size(); i++) {
-          distances[query_index * K + i] = top_k[i].first;
-          results[query_index * K + i] = top_k[i].second;
+    {
+      // Release python GIL while searching. Searches can then overlap with other
+      // methods called from Python threads. Mutators such as `reorder` are not safe
+      // to run concurrently with a search on the same index.
+      py::gil_scoped_release gil;
+
+      // No need to spawn any threads if we are in a single-threaded environment
+      if (num_threads == 1) {
+        for (size_t query_index = 0; query_index < num_queries; query_index++) {
+          std::vector<std::pair<float, label_t>> top_k = this->_index->search(
+              /* query = */ (const void*)queries.data(query_index), /* K = */ K,
+              /* ef_search = */ ef_search,
+              /* num_initializations = */ num_initializations);
+
+          if (top_k.size() != K) {
+            throw std::runtime_error(
+                "Search did not return the expected number "
+                "of results. Expected " +
+                std::to_string(K) + " but got " + std::to_string(top_k.size()) + ".");
+          }
+
+          for (size_t i = 0; i < top_k.size(); i++) {
+            distances[query_index * K + i] = top_k[i].first;
+            results[query_index * K + i] = top_k[i].second;
+          }
         }
+      } else {
+        // Parallelize the search
+        flatnav::executeInParallel(
+            /* start_index = */ 0, /* end_index = */ num_queries,
+            /* num_threads = */ num_threads,
+            /* function = */ [&](uint32_t row_index) {
+              auto* query = (const void*)queries.data(row_index);
+              std::vector<std::pair<float, label_t>> top_k = this->_index->search(
+                  /* query = */ query, /* K = */ K, /* ef_search = */ ef_search,
+                  /* num_initializations = */ num_initializations);
+
+              for (uint32_t result_id = 0; result_id < K; result_id++) {
+                distances[(row_index * K) + result_id] = top_k[result_id].first;
+                results[(row_index * K) + result_id] = top_k[result_id].second;
+              }
+            });
       }
-    } else {
-      // Parallelize the search
-      flatnav::executeInParallel(
-          /* start_index = */ 0, /* end_index = */ num_queries,
-          /* num_threads = */ num_threads,
-          /* function = */ [&](uint32_t row_index) {
-            auto* query = (const void*)queries.data(row_index);
-            std::vector<std::pair<float, label_t>> top_k = this->_index->search(
-                /* query = */ query, /* K = */ K, /* ef_search = */ ef_search,
-                /* num_initializations = */ num_initializations);
-
-            for (uint32_t result_id = 0; result_id < K; result_id++) {
-              distances[(row_index * K) + result_id] = top_k[result_id].first;
-              results[(row_index * K) + result_id] = top_k[result_id].second;
-            }
-          });
     }
 
     // Allows to transfer ownership to Python
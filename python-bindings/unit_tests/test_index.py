@@ -3,6 +3,8 @@ from flatnav.index import IndexL2Float, IndexIPFloat
 from typing import Union, Optional
 import numpy as np
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .test_utils import (
     generate_random_data,
     get_ann_benchmark_dataset,
@@ -120,6 +122,72 @@ def test_flatnav_index_with_reordering():
     )
 
 
+def test_search_single_is_consistent_across_python_threads():
+    training_set = generate_random_data(dataset_length=10_000, dim=128)
+    queries = generate_random_data(dataset_length=1_000, dim=128)
+
+    index = create_index(
+        distance_type="l2",
+        dim=training_set.shape[1],
+        dataset_size=training_set.shape[0],
+        max_edges_per_node=16,
+    )
+    index.add(data=training_set, ef_construction=64)
+
+    def search(query: np.ndarray) -> np.ndarray:
+        _, indices = index.search_single(
+            query=query, ef_search=32, K=10, num_initializations=100
+        )
+        return indices
+
+    # Searching the same index from several Python threads must give the same results
+    # as searching it sequentially.
+    sequential_results = [search(query) for query in queries]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        concurrent_results = list(executor.map(search, queries))
+
+    for expected, actual in zip(sequential_results, concurrent_results):
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_search_releases_gil():
+    training_set = generate_random_data(dataset_length=10_000, dim=128)
+    queries = generate_random_data(dataset_length=5_000, dim=128)
+
+    index = create_index(
+        distance_type="l2",
+        dim=training_set.shape[1],
+        dataset_size=training_set.shape[0],
+        max_edges_per_node=16,
+    )
+    index.add(data=training_set, ef_construction=64)
+    index.set_num_threads(1)
+
+    search_window = []
+    search_done = threading.Event()
+
+    def search() -> None:
+        start = time.perf_counter()
+        index.search(queries=queries, ef_search=500, K=100, num_initializations=100)
+        search_window.extend([start, time.perf_counter()])
+        search_done.set()
+
+    # A Python thread records timestamps for as long as the search runs. If the GIL is
+    # held for the whole search, it can only record them right before and right after
+    # the search, never in the middle of it.
+    worker = threading.Thread(target=search)
+    worker.start()
+    timestamps = []
+    while not search_done.is_set():
+        timestamps.append(time.perf_counter())
+    worker.join()
+
+    start, end = search_window
+    middle_start = start + (end - start) / 3
+    middle_end = end - (end - start) / 3
+    assert any(middle_start <= timestamp <= middle_end for timestamp in timestamps)
+
+
 def run_test(
     index: Union[IndexL2Float, IndexIPFloat],
     ef_construction: int,